@@ -2,21 +2,65 @@
 """
 H100 Inference Server for LexOS
 Provides endpoints for text, image, and video generation
+
+Requests are coalesced into micro-batches by an async scheduler so the GPU
+runs one batched forward pass per window instead of one pass per request.
+Install dependencies with `pip install -r requirements-h100.txt`, then run
+with a single worker so one event loop owns the GPU:
+    scripts/start-h100-inference.sh
 """
 
 import os
+import io
 import json
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+import base64
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Union
+
+import httpx
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+from PIL import Image, ImageDraw
 
-app = Flask(__name__)
-CORS(app)
+app = FastAPI(title="H100 Inference Server", default_response_class=ORJSONResponse)
+
+# Enable CORS
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Batching configuration
+BATCH_WINDOW_S = float(os.environ.get('BATCH_WINDOW_MS', 20)) / 1000
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 16))
+
+# GPU memory configuration (activation shape defaults to a 13B Llama-style model)
+GPU_MEMORY_FRACTION = float(os.environ.get('GPU_MEMORY_FRACTION', 0.9))
+MAX_SEQ_LEN = int(os.environ.get('MAX_SEQ_LEN', 2048))
+MODEL_D_MODEL = int(os.environ.get('MODEL_D_MODEL', 5120))
+
+# Optional vLLM OpenAI-compatible backend for text generation
+# (e.g. http://localhost:8001/v1). vLLM does its own continuous batching and
+# KV-cache management, so text requests bypass the local micro-batcher and
+# no GPU memory is primed in this process when set.
+VLLM_URL = os.environ.get('VLLM_URL')
+VLLM_MODEL = os.environ.get('VLLM_MODEL', 'qwen2-vl')
+VLLM_TIMEOUT = httpx.Timeout(300.0, connect=1.0)
+
+# Shared keep-alive connection pool for vLLM calls, created on startup
+VLLM_CLIENT: httpx.AsyncClient = None
+
 # Check for GPU availability
 try:
     import torch
@@ -34,7 +78,7 @@ except ImportError:
 def load_text_models():
     """Load text generation models"""
     models = {}
-    
+
     if GPU_AVAILABLE:
         logger.info("Loading text models on GPU...")
         # TODO: Load actual models like:
@@ -43,13 +87,13 @@ def load_text_models():
         # - OpenHermes 2.5
     else:
         logger.warning("No GPU - text models not loaded")
-    
+
     return models
 
 def load_image_models():
     """Load image generation models"""
     models = {}
-    
+
     if GPU_AVAILABLE:
         logger.info("Loading image models on GPU...")
         # TODO: Load actual models like:
@@ -58,84 +102,228 @@ def load_image_models():
         # - RevAnimated
     else:
         logger.warning("No GPU - image models not loaded")
-    
+
     return models
 
 # Initialize models
 TEXT_MODELS = load_text_models()
 IMAGE_MODELS = load_image_models()
 
-@app.route('/health', methods=['GET'])
-def health():
+def prime_gpu_memory():
+    """Cap this process's HBM share and pool a max-size block up front so
+    /generate doesn't pay cudaMalloc on its first full batch"""
+    if not GPU_AVAILABLE or VLLM_URL:
+        return
+
+    torch.cuda.set_per_process_memory_fraction(GPU_MEMORY_FRACTION)
+
+    # Touch a max-size activation tensor so the caching allocator keeps the
+    # block pooled for later requests. Never call torch.cuda.empty_cache()
+    # from the request path - it hands these blocks back to the driver.
+    try:
+        warmup = torch.empty(MAX_BATCH_SIZE, MAX_SEQ_LEN, MODEL_D_MODEL, device='cuda', dtype=torch.bfloat16)
+        size_gb = warmup.numel() * warmup.element_size() / 1e9
+        del warmup
+    except torch.cuda.OutOfMemoryError:
+        logger.warning("Not enough GPU memory to prime the allocator - allocating per request instead")
+        torch.cuda.empty_cache()
+        return
+
+    logger.info(f"GPU allocator primed with {size_gb:.1f} GB")
+
+class GenerateRequest(BaseModel):
+    prompt: str = ''
+    model: str = 'default'
+    max_tokens: int = 1000
+
+class ImageRequest(BaseModel):
+    prompt: str = ''
+    model: str = 'stable-diffusion-2.1'
+
+def render_placeholder_image():
+    """Render the no-GPU placeholder once as a PNG data URL"""
+    img = Image.new('RGB', (1024, 1024), (255, 107, 107))
+    ImageDraw.Draw(img).text((300, 500), 'H100 GPU Not Available', fill=(255, 255, 255))
+    buf = io.BytesIO()
+    img.save(buf, 'PNG', optimize=True)
+    return 'data:image/png;base64,' + base64.b64encode(buf.getvalue()).decode()
+
+# Served inline so clients don't make an extra external round-trip
+PLACEHOLDER_IMAGE_URL = render_placeholder_image()
+
+@dataclass
+class InferenceRequest:
+    """A single queued prompt waiting to be batched"""
+    prompt: str
+    params: Dict[str, Any]
+    future: asyncio.Future = field(repr=False)
+
+async def generate_with_vllm(prompt: str, params: Dict[str, Any]) -> Union[Dict[str, Any], ORJSONResponse]:
+    """Forward one prompt to vLLM, which batches concurrent requests itself"""
+    try:
+        response = await VLLM_CLIENT.post(
+            f"{VLLM_URL}/completions",
+            json={
+                'model': VLLM_MODEL,
+                'prompt': prompt,
+                'max_tokens': params['max_tokens']
+            }
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.error(f"vLLM request failed: {e!r}")
+        return ORJSONResponse({'error': 'vLLM backend unavailable'}, status_code=502)
+    data = response.json()
+    return {
+        'text': data['choices'][0]['text'],
+        'tokens_used': data['usage']['completion_tokens'],
+        'model': params['model'],
+        'gpu_used': True
+    }
+
+def run_text_batch(batch: List[InferenceRequest]) -> List[Dict[str, Any]]:
+    """Run one text generation pass for a whole batch"""
+    if not GPU_AVAILABLE:
+        # Return mock responses if no GPU
+        return [{
+            'text': f"[Mock H100 Response] I would generate text for: '{req.prompt}' using model {req.params['model']}",
+            'tokens_used': len(req.prompt.split()) * 2,
+            'model': req.params['model'],
+            'gpu_used': False
+        } for req in batch]
+
+    prompts = [req.prompt for req in batch]
+    with torch.inference_mode():
+        # TODO: Implement actual model inference as a single batched call:
+        # outputs = model.generate(prompts, max_new_tokens=...)
+        return [{
+            'text': f"Generated response for: {prompt}",
+            'tokens_used': req.params['max_tokens'],
+            'model': req.params['model'],
+            'gpu_used': True
+        } for prompt, req in zip(prompts, batch)]
+
+def run_image_batch(batch: List[InferenceRequest]) -> List[Dict[str, Any]]:
+    """Run one image generation pass for a whole batch"""
+    if not GPU_AVAILABLE:
+        # Return placeholder if no GPU
+        return [{
+            'image_url': PLACEHOLDER_IMAGE_URL,
+            'prompt': req.prompt,
+            'model': req.params['model'],
+            'gpu_used': False
+        } for req in batch]
+
+    prompts = [req.prompt for req in batch]
+    with torch.inference_mode():
+        # TODO: Implement actual image generation as a single call:
+        # images = pipeline(prompts).images
+        return [{
+            'image_url': 'generated_image_url_here',
+            'prompt': prompt,
+            'model': req.params['model'],
+            'gpu_used': True
+        } for prompt, req in zip(prompts, batch)]
+
+# A single thread owns the GPU so batches never interleave and the event
+# loop stays free to accept new requests while a batch is running
+GPU_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu")
+TEXT_QUEUE: "asyncio.Queue[InferenceRequest]" = None
+IMAGE_QUEUE: "asyncio.Queue[InferenceRequest]" = None
+
+async def drain_more(queue: asyncio.Queue, batch: List[InferenceRequest]):
+    """Keep pulling requests into the batch until it is full"""
+    while len(batch) < MAX_BATCH_SIZE:
+        batch.append(await queue.get())
+
+async def batch_worker(queue: asyncio.Queue, run_batch: Callable):
+    """Collect requests for one batching window and dispatch them together"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        try:
+            await asyncio.wait_for(drain_more(queue, batch), timeout=BATCH_WINDOW_S)
+        except asyncio.TimeoutError:
+            pass
+
+        # Drop requests whose clients went away while queued
+        batch = [req for req in batch if not req.future.done()]
+        if not batch:
+            continue
+
+        try:
+            results = await loop.run_in_executor(GPU_EXECUTOR, run_batch, batch)
+        except Exception as e:
+            logger.error(f"Batch of {len(batch)} failed: {e}")
+            for req in batch:
+                if not req.future.done():
+                    req.future.set_exception(e)
+            continue
+
+        for req, result in zip(batch, results):
+            if not req.future.done():
+                req.future.set_result(result)
+
+async def submit(queue: asyncio.Queue, prompt: str, params: Dict[str, Any]):
+    """Queue a prompt for the next batch and wait for its result"""
+    req = InferenceRequest(prompt, params, asyncio.get_running_loop().create_future())
+    await queue.put(req)
+    return await req.future
+
+@app.on_event("startup")
+async def start_batch_workers():
+    global TEXT_QUEUE, IMAGE_QUEUE, VLLM_CLIENT
+    prime_gpu_memory()
+    if VLLM_URL:
+        VLLM_CLIENT = httpx.AsyncClient(
+            timeout=VLLM_TIMEOUT,
+            limits=httpx.Limits(max_connections=256, max_keepalive_connections=64)
+        )
+    TEXT_QUEUE = asyncio.Queue()
+    IMAGE_QUEUE = asyncio.Queue()
+    app.state.batch_workers = [
+        asyncio.create_task(batch_worker(TEXT_QUEUE, run_text_batch)),
+        asyncio.create_task(batch_worker(IMAGE_QUEUE, run_image_batch)),
+    ]
+    logger.info(f"H100 Inference Server ready (GPU Available: {GPU_AVAILABLE})")
+    logger.info(f"Batch scheduler started (window={BATCH_WINDOW_S * 1000:.0f}ms, max_batch={MAX_BATCH_SIZE})")
+
+@app.on_event("shutdown")
+async def stop_batch_workers():
+    for task in app.state.batch_workers:
+        task.cancel()
+    GPU_EXECUTOR.shutdown(wait=False)
+    if VLLM_CLIENT is not None:
+        await VLLM_CLIENT.aclose()
+
+@app.get('/health')
+async def health():
     """Health check endpoint"""
-    return jsonify({
+    return {
         'status': 'ok',
         'gpu_available': GPU_AVAILABLE,
         'models_loaded': bool(TEXT_MODELS or IMAGE_MODELS)
-    })
+    }
 
-@app.route('/generate', methods=['POST'])
-def generate_text():
+@app.post('/generate')
+async def generate_text(req: GenerateRequest):
     """Text generation endpoint"""
-    data = request.json
-    prompt = data.get('prompt', '')
-    model = data.get('model', 'default')
-    max_tokens = data.get('max_tokens', 1000)
-    
-    if not GPU_AVAILABLE:
-        # Return mock response if no GPU
-        return jsonify({
-            'text': f"[Mock H100 Response] I would generate text for: '{prompt}' using model {model}",
-            'tokens_used': len(prompt.split()) * 2,
-            'model': model,
-            'gpu_used': False
-        })
-    
-    # TODO: Implement actual model inference
-    return jsonify({
-        'text': f"Generated response for: {prompt}",
-        'tokens_used': max_tokens,
-        'model': model,
-        'gpu_used': True
-    })
+    params = {'model': req.model, 'max_tokens': req.max_tokens}
+    if VLLM_URL:
+        return await generate_with_vllm(req.prompt, params)
 
-@app.route('/generate-image', methods=['POST'])
-def generate_image():
+    return await submit(TEXT_QUEUE, req.prompt, params)
+
+@app.post('/generate-image')
+async def generate_image(req: ImageRequest):
     """Image generation endpoint"""
-    data = request.json
-    prompt = data.get('prompt', '')
-    model = data.get('model', 'stable-diffusion-2.1')
-    
-    if not GPU_AVAILABLE:
-        # Return placeholder if no GPU
-        return jsonify({
-            'image_url': f"https://via.placeholder.com/1024x1024/FF6B6B/FFFFFF?text=H100+GPU+Not+Available",
-            'prompt': prompt,
-            'model': model,
-            'gpu_used': False
-        })
-    
-    # TODO: Implement actual image generation
-    return jsonify({
-        'image_url': 'generated_image_url_here',
-        'prompt': prompt,
-        'model': model,
-        'gpu_used': True
-    })
+    return await submit(IMAGE_QUEUE, req.prompt, {'model': req.model})
 
-@app.route('/models', methods=['GET'])
-def list_models():
+@app.get('/models')
+async def list_models():
     """List available models"""
-    return jsonify({
+    return {
         'text_models': list(TEXT_MODELS.keys()) if TEXT_MODELS else ['none_loaded'],
         'image_models': list(IMAGE_MODELS.keys()) if IMAGE_MODELS else ['none_loaded'],
         'gpu_available': GPU_AVAILABLE
-    })
-
-if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 5000))
-    logger.info(f"Starting H100 Inference Server on port {port}")
-    logger.info(f"GPU Available: {GPU_AVAILABLE}")
-    
-    # Note: In production, use a proper WSGI server like gunicorn
-    app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+    }
@@ -3,7 +3,63 @@ from rasa_sdk import Action, Tracker
 from rasa_sdk.executor import CollectingDispatcher
 from rasa_sdk.events import SlotSet, FollowupAction
 import requests
+from requests.adapters import HTTPAdapter
+from cachetools import TTLCache
+from threading import Lock
+import pybreaker
+import hashlib
 import json
+import os
+import re
+
+LEXOS_API_URL = os.environ.get("LEXOS_API_URL", "http://localhost:3000")
+
+# Shared keep-alive connection pool for all calls to the Lexos backend
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=1))
+
+# (connect, read) timeouts so hung sockets can't starve the pool
+API_TIMEOUT = (0.5, 3.0)
+# The browser agent's page.goto allows up to 30s before giving up
+BROWSER_TIMEOUT = (0.5, 35.0)
+# LLM and image generation legitimately take longer to respond
+AI_TIMEOUT = (0.5, 60.0)
+
+# Fail fast for a while once a backend service keeps erroring instead of
+# paying a connection timeout on every message. One breaker per service so
+# a slow browser agent doesn't take task management or chat down with it.
+TASKS_CB = pybreaker.CircuitBreaker(fail_max=5, reset_timeout=15)
+BROWSER_CB = pybreaker.CircuitBreaker(fail_max=5, reset_timeout=15)
+AI_CB = pybreaker.CircuitBreaker(fail_max=5, reset_timeout=15)
+BACKEND_ERRORS = (requests.RequestException, pybreaker.CircuitBreakerError)
+
+def orch_post(breaker: pybreaker.CircuitBreaker, path: Text, payload: Dict[Text, Any],
+              timeout=API_TIMEOUT) -> requests.Response:
+    return breaker.call(SESSION.post, f"{LEXOS_API_URL}{path}", json=payload, timeout=timeout)
+
+def orch_get(breaker: pybreaker.CircuitBreaker, path: Text, timeout=API_TIMEOUT) -> requests.Response:
+    return breaker.call(SESSION.get, f"{LEXOS_API_URL}{path}", timeout=timeout)
+
+# Leading request phrases stripped from image prompts
+IMAGE_PROMPT_PREFIX = re.compile(
+    r'^\s*(?:generate an image of|create a picture of|make an image showing)\s+',
+    re.IGNORECASE
+)
+
+# Short-lived cache of AI/image results for repeated identical prompts
+RESPONSE_CACHE = TTLCache(maxsize=1024, ttl=300)
+CACHE_LOCK = Lock()
+
+def cache_key(*parts: Text) -> bytes:
+    return hashlib.blake2b(json.dumps(parts).encode(), digest_size=16).digest()
+
+def cache_get(key: bytes):
+    with CACHE_LOCK:
+        return RESPONSE_CACHE.get(key)
+
+def cache_put(key: bytes, value: Text):
+    with CACHE_LOCK:
+        RESPONSE_CACHE[key] = value
 
 class ActionCreateTask(Action):
     def name(self) -> Text:
@@ -18,15 +74,16 @@ class ActionCreateTask(Action):
         if task_name:
             # Call the orchestrator API to create task
             try:
-                response = requests.post(
-                    "http://localhost:3000/api/orchestrator/tasks",
-                    json={"name": task_name, "status": "pending"}
+                response = orch_post(
+                    TASKS_CB,
+                    "/api/orchestrator/tasks",
+                    {"name": task_name, "status": "pending"}
                 )
                 if response.ok:
                     dispatcher.utter_message(text=f"✅ Task '{task_name}' has been created!")
                 else:
                     dispatcher.utter_message(text=f"Sorry, I couldn't create the task. Please try again.")
-            except:
+            except BACKEND_ERRORS:
                 dispatcher.utter_message(text="I'm having trouble connecting to the task service.")
         else:
             dispatcher.utter_message(text="What task would you like me to create?")
@@ -42,7 +99,7 @@ class ActionListTasks(Action):
             domain: Dict[Text, Any]) -> List[Dict[Text, Any]]:
         
         try:
-            response = requests.get("http://localhost:3000/api/orchestrator/tasks")
+            response = orch_get(TASKS_CB, "/api/orchestrator/tasks")
             if response.ok:
                 tasks = response.json()
                 if tasks:
@@ -53,7 +110,7 @@ class ActionListTasks(Action):
                     dispatcher.utter_message(text=task_list)
                 else:
                     dispatcher.utter_message(text="You don't have any tasks yet. Would you like to create one?")
-        except:
+        except BACKEND_ERRORS:
             dispatcher.utter_message(text="I couldn't retrieve your tasks right now.")
         
         return []
@@ -74,15 +131,17 @@ class ActionBrowseWebsite(Action):
                 website_url = 'https://' + website_url
             
             try:
-                response = requests.post(
-                    "http://localhost:3000/api/browser-agent/navigate",
-                    json={"url": website_url}
+                response = orch_post(
+                    BROWSER_CB,
+                    "/api/browser-agent/navigate",
+                    {"url": website_url},
+                    timeout=BROWSER_TIMEOUT
                 )
                 if response.ok:
                     dispatcher.utter_message(text=f"🌐 I've opened {website_url} for you. You can see it in the browser panel.")
                 else:
                     dispatcher.utter_message(text="I had trouble opening that website.")
-            except:
+            except BACKEND_ERRORS:
                 dispatcher.utter_message(text="The browser service isn't available right now.")
         else:
             dispatcher.utter_message(text="Which website would you like me to browse?")
@@ -146,26 +205,38 @@ class ActionAIResponse(Action):
         # Get the last user message
         user_message = tracker.latest_message.get('text')
         
+        key = cache_key(user_message, "auto", "general")
+        cached = cache_get(key)
+        if cached is not None:
+            dispatcher.utter_message(text=cached)
+            return []
+        
         try:
             # Call the AI API
-            response = requests.post(
-                "http://localhost:3000/api/ai/chat",
-                json={
+            response = orch_post(
+                AI_CB,
+                "/api/ai/chat",
+                {
                     "prompt": user_message,
                     "model": "auto",
                     "task_type": "general",
                     "complexity": "medium",
                     "quality": "standard"
-                }
+                },
+                timeout=AI_TIMEOUT
             )
             
             if response.ok:
                 data = response.json()
-                ai_response = data.get('result', 'I apologize, but I couldn\'t generate a response.')
+                ai_response = data.get('result')
+                if ai_response:
+                    cache_put(key, ai_response)
+                else:
+                    ai_response = 'I apologize, but I couldn\'t generate a response.'
                 dispatcher.utter_message(text=ai_response)
             else:
                 dispatcher.utter_message(text="I'm having trouble thinking right now. Please try again.")
-        except Exception as e:
+        except BACKEND_ERRORS:
             dispatcher.utter_message(text="I'm experiencing some technical difficulties. Please try again later.")
         
         return []
@@ -181,26 +252,36 @@ class ActionGenerateImage(Action):
         # Extract image description from user message
         user_message = tracker.latest_message.get('text')
         # Remove common prefixes
-        prompt = user_message.lower().replace('generate an image of', '').replace('create a picture of', '').replace('make an image showing', '').strip()
+        prompt = IMAGE_PROMPT_PREFIX.sub('', user_message).strip()
+        
+        key = cache_key(prompt, "image")
+        cached = cache_get(key)
+        if cached is not None:
+            dispatcher.utter_message(text=f"🎨 Here's your image:\n\n{cached}")
+            return []
         
         try:
-            response = requests.post(
-                "http://localhost:3000/api/ai/chat",
-                json={
+            response = orch_post(
+                AI_CB,
+                "/api/ai/chat",
+                {
                     "prompt": prompt,
                     "task_type": "image",
                     "complexity": "medium",
                     "quality": "standard"
-                }
+                },
+                timeout=AI_TIMEOUT
             )
             
             if response.ok:
                 data = response.json()
                 result = data.get('result', '')
+                if result:
+                    cache_put(key, result)
                 dispatcher.utter_message(text=f"🎨 Here's your image:\n\n{result}")
             else:
                 dispatcher.utter_message(text="I couldn't generate the image right now.")
-        except:
+        except BACKEND_ERRORS:
             dispatcher.utter_message(text="The image generation service is unavailable.")
         
         return []
@@ -0,0 +1,25 @@
+#!/bin/bash
+
+# Start the H100 inference server behind gunicorn
+# A single worker owns the GPU; its uvicorn event loop (uvloop + httptools
+# when installed) handles concurrent HTTP intake and feeds the batch scheduler.
+echo "🚀 Starting H100 Inference Server..."
+
+PORT=${PORT:-5000}
+cd "$(dirname "$0")/.."
+
+# Dependencies are listed in requirements-h100.txt
+if ! python3 -c "import fastapi, orjson, PIL, httpx, gunicorn, uvicorn" 2>/dev/null; then
+    echo "📦 Installing inference server dependencies..."
+    pip install -q -r requirements-h100.txt
+fi
+
+echo "Starting inference server on http://0.0.0.0:$PORT"
+
+# Model loading happens at import, so allow a generous boot timeout
+exec gunicorn \
+    -k uvicorn.workers.UvicornWorker \
+    -w 1 \
+    --timeout 300 \
+    --bind "0.0.0.0:$PORT" \
+    h100-inference-server:app